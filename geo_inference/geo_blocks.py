@@ -1,7 +1,7 @@
 import logging
 import os
 import sys
-from typing import Any, Dict, Iterator, Optional, Tuple, Union, cast
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union, cast
 
 import numpy as np
 import rasterio as rio
@@ -15,7 +15,7 @@ from torch.nn import functional as F
 from torchgeo.datasets import GeoDataset
 from torchgeo.datasets.utils import BoundingBox
 from torchgeo.samplers import GeoSampler
-from torchgeo.samplers.utils import _to_tuple, tile_to_chips
+from torchgeo.samplers.utils import _to_tuple
 
 from .config.logging_config import logger
 from .utils.helpers import validate_asset_type
@@ -29,22 +29,31 @@ class RasterDataset(GeoDataset):
     
     Attributes:
         image_asset: The path to the image asset.
-        src: The rasterio dataset object.
+        src: The rasterio dataset object, open until close is called. Opened lazily in worker processes.
+        src_meta: A copy of the metadata of the image asset.
         cmap: The colormap of the image asset.
         crs: The coordinate reference system of the image asset.
         res: The resolution of the image asset.
         bands: The number of bands in the image asset.
         index: The rtree index of the image asset.
+        num_threads: The number of GDAL decoding threads of the handles opened by the dataset.
     """
-    def __init__(self, image_asset: str, bbox: str = None) -> None:
+    def __init__(self, image_asset: str, bbox: str = None, num_threads: Optional[int] = None) -> None:
         """Initializes a RasterDataset object.
         
         Args:
             image_asset (str): The path or rasterio dataset of image asset.
             bounding_box (str): The bounding box of image asset.
+            num_threads (int, optional): The number of GDAL decoding threads per handle.
+                Defaults to None, which leaves GDAL's own configuration in place.
         """
         super().__init__()
-        self.src = validate_asset_type(image_asset)
+        self.num_threads = num_threads
+        with self._gdal_env():
+            self.src = validate_asset_type(image_asset)
+        self.image_asset = self.src.name
+        self._src_pid = os.getpid()
+        self.src_meta = self.src.meta.copy()
             
         try:
             self.cmap = self.src.colormap(1)
@@ -85,29 +94,66 @@ class RasterDataset(GeoDataset):
         self.image_height = image_height
         self.image_width = image_width
     
-    def __getitem__(self, query: Dict[str, Any]) -> Dict[str, Any]:
+    def __getitem__(self, query: List[int]) -> Dict[str, Any]:
         """
         Get a sample from the dataset.
 
         Args:
-            query: A dictionary containing the query parameters.
+            query: A row of the sampler table (x_min, y_min, patch_width, patch_height, window_id).
 
         Returns:
             A dictionary containing the sample data.
         """
-        filepath = query['path']
-        window = query["window"]
-        pixel_coords = query["pixel_coords"]
-        patch_size = pixel_coords[-1]
+        x_min, y_min, patch_width, patch_height, _ = query
         
-        data = self._get_tensor(pixel_coords, patch_size)
-        sample = {"image": data, 
-                  "crs": self.crs,
-                  "pixel_coords": pixel_coords, 
-                  "window": window,
-                  "path": filepath}
-
-        return sample
+        data = self._get_tensor((x_min, y_min, patch_width, patch_height), patch_height)
+
+        return self._make_sample(data, query)
+    
+    def __getitems__(self, queries: List[List[int]]) -> List[Dict[str, Any]]:
+        """
+        Get a batch of samples from the dataset.
+
+        Patches sharing a row are read with a single window spanning all of them
+        and sliced apart in memory.
+
+        Args:
+            queries: Rows of the sampler table (x_min, y_min, patch_width, patch_height, window_id).
+
+        Returns:
+            A list of dictionaries containing the sample data, in the order of the queries.
+        """
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, (_, y_min, _, patch_height, _) in enumerate(queries):
+            groups.setdefault((y_min, patch_height), []).append(i)
+        
+        samples: List[Dict[str, Any]] = [{} for _ in queries]
+        for (y_min, patch_height), indices in groups.items():
+            x_start = min(queries[i][0] for i in indices)
+            x_stop = max(queries[i][0] + queries[i][2] for i in indices)
+            stripe = self._read((x_start, y_min, x_stop - x_start, patch_height))
+            for i in indices:
+                x_min, patch_width = queries[i][0] - x_start, queries[i][2]
+                data = self._to_tensor(stripe[:, :, x_min : x_min + patch_width], patch_height)
+                samples[i] = self._make_sample(data, queries[i])
+        
+        return samples
+    
+    @staticmethod
+    def _make_sample(data: Tensor, query: List[int]) -> Dict[str, Any]:
+        """
+        Build a sample from a patch and its row of the sampler table.
+
+        Args:
+            data: The tensor patch.
+            query: The row of the sampler table of the patch.
+
+        Returns:
+            A dictionary containing the sample data.
+        """
+        return {"image": data, 
+                "pixel_coords": torch.tensor(query[:4], dtype=torch.int32), 
+                "window_id": torch.tensor(query[4], dtype=torch.int32)}
     
     def _get_tensor(self, query, size):
         """
@@ -120,22 +166,89 @@ class RasterDataset(GeoDataset):
         Returns:
             A torch tensor patch.
         """
-        (x_min, y_min, patch_width, patch_height) = query
+        return self._to_tensor(self._read(query), size)
+    
+    def _read(self, query) -> np.ndarray:
+        """
+        Read the pixels covered by the given query (pixel coordinates).
+
+        Args:
+            query: The pixel coordinates of the region.
+
+        Returns:
+            The pixels of the region, clipped to the image bounds.
+        """
+        (x_min, y_min, width, height) = query
         
-        window = Window.from_slices(slice(y_min, y_min + patch_height),
-                                    slice(x_min, x_min + patch_width))
+        window = Window.from_slices(slice(y_min, y_min + height),
+                                    slice(x_min, x_min + width))
         
-        dest = self.src.read(window=window)
+        dest = self._get_src().read(window=window)
         if dest.dtype == np.uint16:
             dest = dest.astype(np.int32)
         elif dest.dtype == np.uint32:
             dest = dest.astype(np.int64)
+        
+        return dest
+    
+    def _to_tensor(self, dest: np.ndarray, size: int) -> Tensor:
+        """
+        Convert the pixels of a patch to a padded tensor.
 
-        tensor = torch.tensor(dest)
+        Args:
+            dest: The pixels of the patch.
+            size: The desired patch size.
+
+        Returns:
+            A torch tensor patch.
+        """
+        # Wrap the buffer without copying, patches sliced from a row read included
+        tensor = torch.from_numpy(dest)
         tensor = self.pad_patch(tensor, size)
         
         return tensor
     
+    def _get_src(self) -> rio.DatasetReader:
+        """
+        Get the dataset handle opened by the current process.
+
+        The handle is opened once and reused for every patch. DataLoader workers
+        reopen the asset on first use, since a GDAL handle must not be shared
+        across processes and is not pickled for spawned workers.
+
+        Returns:
+            The rasterio dataset object.
+        """
+        if self.src is None or self._src_pid != os.getpid():
+            with self._gdal_env():
+                self.src = rio.open(self.image_asset, sharing=False)
+            self._src_pid = os.getpid()
+        return self.src
+    
+    def _gdal_env(self) -> rio.Env:
+        """
+        Get the GDAL environment handles are opened in. GDAL reads the thread count when a dataset is opened.
+
+        Returns:
+            The rasterio environment.
+        """
+        options = {"GDAL_NUM_THREADS": self.num_threads} if self.num_threads else {}
+        return rio.Env(**options)
+    
+    def close(self) -> None:
+        """
+        Close the dataset handle of the current process.
+        """
+        if self.src is not None:
+            self.src.close()
+    
+    def __getstate__(self):
+        """
+        Drop the dataset handle when pickling, e.g. for spawned DataLoader workers.
+        """
+        attrs, tuples = super().__getstate__()
+        return {**attrs, "src": None}, tuples
+    
     @staticmethod
     def pad_patch(x: Tensor, patch_size: int):
         """
@@ -151,6 +264,9 @@ class RasterDataset(GeoDataset):
         h, w = x.shape[-2:]
         pad_h = patch_size - h
         pad_w = patch_size - w
+        # Interior patches are already full size
+        if pad_h == 0 and pad_w == 0:
+            return x
         # pads are described starting from the last dimension and moving forward.
         x = F.pad(x, (0, pad_w, 0, pad_h))
         return x
@@ -160,13 +276,16 @@ class InferenceSampler(GeoSampler):
     """Class for creating an inference sampler.
 
     This class extends GeoSampler and is designed for generating patches
-    for inference on a GeoDataset.
+    for inference on a GeoDataset. Patches are precomputed into a table and
+    yielded as its rows.
 
     Attributes:
         dataset (GeoDataset): The dataset to generate patches from.
         size (Union[Tuple[float, float], float]): Dimensions of each patch.
         stride (Union[Tuple[float, float], float]): Distance to skip between each patch.
         roi (Optional[BoundingBox]): Region of interest to sample from.
+        windows (torch.Tensor): The signal windows of the patches, indexed by window_id.
+        table (torch.Tensor): The patches to sample as rows of (x_min, y_min, patch_width, patch_height, window_id).
     """
     def __init__(self,
                  dataset: GeoDataset,
@@ -188,77 +307,41 @@ class InferenceSampler(GeoSampler):
         self.patch_size = self.size
         self.stride = _to_tuple(stride)
         
-        # Generates 9 2D signal windows of patch size that covers edge and corner coordinates
-        self.windows = torch.tensor(self.generate_corner_windows(self.patch_size[0]), dtype=torch.float32)
+        # Generates 9 2D signal windows of patch size that covers edge and corner coordinates,
+        # followed by an all-ones window for images smaller than a patch. Patches refer to them by index.
+        windows = self.generate_corner_windows(self.patch_size[0]).reshape(9, *self.patch_size)
+        windows = np.concatenate([windows, np.ones((1, *self.patch_size))])
+        self.windows = torch.from_numpy(windows).to(torch.float16)
         self.size_in_crs_units = (self.size[0] * self.res, self.size[1] * self.res)
         self.stride_in_crs_units = (self.stride[0] * self.res, self.stride[1] * self.res)
         self.hits = []
         self.hits_small = []
+        self.im_height = 0
+        self.im_width = 0
+        rows = []
         for hit in self.index.intersection(tuple(self.roi), objects=True):
             bounds = BoundingBox(*hit.bounds)
+            im_height = round((bounds.maxy - bounds.miny) / self.res)
+            im_width = round((bounds.maxx - bounds.minx) / self.res)
+            # The merge canvas must cover every hit
+            self.im_height = max(self.im_height, im_height)
+            self.im_width = max(self.im_width, im_width)
             if (bounds.maxx - bounds.minx >= self.size_in_crs_units[1]
                 and bounds.maxy - bounds.miny >= self.size_in_crs_units[0]):
                 self.hits.append(hit)
+                rows.append(self.generate_patch_coords(im_height, im_width, self.size, self.stride))
             else:
                 self.hits_small.append(hit)
-        
-        self.length = 0
-        for hit in self.hits:
-            bounds = BoundingBox(*hit.bounds)
-            rows, cols = tile_to_chips(bounds=bounds, size=self.size_in_crs_units, stride=self.stride_in_crs_units)
-            self.length += rows * cols
-        
-        for hit in self.hits_small:
-            bounds = BoundingBox(*hit.bounds)
-            self.length += 1
-        
-        for hit in self.hits + self.hits_small:
-            if hit in self.hits:
-                bounds = BoundingBox(*hit.bounds)
-                self.im_height = round((bounds.maxy - bounds.miny) / self.res)
-                self.im_width = round((bounds.maxx - bounds.minx) / self.res)
-            else:
-                bounds = BoundingBox(*hit.bounds) 
-                self.im_height = round((bounds.maxy - bounds.miny) / self.res)
-                self.im_width = round((bounds.maxx - bounds.minx) / self.res)
+                rows.append(np.array([[0, 0, self.patch_size[1], self.patch_size[0], len(self.windows) - 1]]))
+        table = np.concatenate(rows) if rows else np.empty((0, 5))
+        self.table = torch.from_numpy(table).to(torch.int32)
+        self.length = len(self.table)
                 
-    def __iter__(self) -> Iterator[Dict[str, Any]]:
-        """
-        Yields a dictionary containing the pixel coordinates, path, and window.
-        """
-        for hit in self.hits + self.hits_small:
-            if hit in self.hits:
-                y_steps = int(np.ceil((self.im_height - self.size[0]) / self.stride[0]) + 1)
-                x_steps = int(np.ceil((self.im_width - self.size[1]) / self.stride[1]) + 1)
-                for y in range(y_steps):
-                    if self.stride[0] * y + self.size[0] > self.im_height:
-                        y_min = self.im_height - self.size[0]
-                    else:
-                        y_min = self.stride[0] * y
-                    for x in range(x_steps):
-                        if self.stride[1] * x + self.size[1] > self.im_width:
-                            x_min = self.im_width - self.size[1]
-                        else:
-                            x_min = self.stride[1] * x
-                        # get center, border and corner windows
-                        border_x, border_y = 1, 1
-                        if y == 0: border_x = 0
-                        if x == 0: border_y = 0
-                        if y == y_steps - 1: border_x = 2
-                        if x == x_steps - 1: border_y = 2
-                        # Select the right window
-                        current_window = self.windows[border_x, border_y]
-                        query = {"pixel_coords": (x_min, y_min, self.patch_size[1], self.patch_size[0]),
-                                 "path": cast(str, hit.object),
-                                 "window": current_window}
-                        yield query
-            else:
-                x_min, y_min = (0, 0)
-                current_window = torch.ones((self.patch_size[0], self.patch_size[1]))
-                query = {"pixel_coords": (x_min, y_min, self.patch_size[1], self.patch_size[0]),
-                         "path": cast(str, hit.object),
-                         "window": current_window}
-                yield query
+    def __iter__(self) -> Iterator[List[int]]:
+        """
+        Yields the rows of the patch table as lists of ints, which are cheap to send to DataLoader workers.
+        """
+        yield from self.table.tolist()
     
     def __len__(self) -> int:
         """
@@ -269,11 +352,50 @@ class InferenceSampler(GeoSampler):
         """
         return self.length
     
+    @staticmethod
+    def generate_patch_coords(im_height: int,
+                              im_width: int,
+                              size: Tuple[int, int],
+                              stride: Tuple[int, int]) -> np.ndarray:
+        """
+        Generates the pixel coordinates and window index of every patch in row-major order.
+        
+        Patches that would overrun the image are shifted back inside its bounds. The window
+        index selects the corner, border or center window of the patch position from the
+        flattened (3, 3) stack of generate_corner_windows.
+
+        Args:
+            im_height (int): The height of the image.
+            im_width (int): The width of the image.
+            size (Tuple[int, int]): The size of the patch.
+            stride (Tuple[int, int]): The stride of the patch.
+
+        Returns:
+            np.ndarray: Array of shape (N, 5) holding x_min, y_min, patch_width, patch_height and window index.
+        """
+        y_steps = int(np.ceil((im_height - size[0]) / stride[0]) + 1)
+        x_steps = int(np.ceil((im_width - size[1]) / stride[1]) + 1)
+        ys = np.minimum(np.arange(y_steps) * stride[0], im_height - size[0])
+        xs = np.minimum(np.arange(x_steps) * stride[1], im_width - size[1])
+        # get center, border and corner windows
+        border_x = np.ones(y_steps, dtype=np.int64)
+        border_x[0], border_x[-1] = 0, 2
+        border_y = np.ones(x_steps, dtype=np.int64)
+        border_y[0], border_y[-1] = 0, 2
+        yy, xx = np.meshgrid(ys, xs, indexing="ij")
+        window_ids = border_x[:, np.newaxis] * 3 + border_y[np.newaxis, :]
+        patch_width = np.full_like(xx, size[1])
+        patch_height = np.full_like(yy, size[0])
+        return np.stack([xx, yy, patch_width, patch_height, window_ids], axis=-1).reshape(-1, 5)
+    
     @staticmethod
     def generate_corner_windows(window_size: int) -> np.ndarray:
         """
         Generates 9 2D signal windows that covers edge and corner coordinates
         
+        Every window is the outer product of two 1D profiles: the hann window, or the hann
+        window held at its peak over its first (leading edge) or second (trailing edge) half.
+        
         Args:
             window_size (int): The size of the window.
 
@@ -281,23 +403,10 @@ class InferenceSampler(GeoSampler):
             np.ndarray: 9 2D signal windows stacked in array (3, 3).
         """
         step = window_size >> 1
-        window = np.matrix(w.hann(M=window_size, sym=False))
-        window = window.T.dot(window)
-        window_u = np.vstack([np.tile(window[step:step+1, :], (step, 1)), window[step:, :]])
-        window_b = np.vstack([window[:step, :], np.tile(window[step:step+1, :], (step, 1))])
-        window_l = np.hstack([np.tile(window[:, step:step+1], (1, step)), window[:, step:]])
-        window_r = np.hstack([window[:, :step], np.tile(window[:, step:step+1], (1, step))])
-        window_ul = np.block([[np.ones((step, step)), window_u[:step, step:]],
-                              [window_l[step:, :step], window_l[step:, step:]]])
-        window_ur = np.block([[window_u[:step, :step], np.ones((step, step))],
-                              [window_r[step:, :step], window_r[step:, step:]]])
-        window_bl = np.block([[window_l[:step, :step], window_l[:step, step:]],
-                              [np.ones((step, step)), window_b[step:, step:]]])
-        window_br = np.block([[window_r[:step, :step], window_r[:step, step:]],
-                              [window_b[step:, :step], np.ones((step, step))]])
-        return np.array([[window_ul, window_u, window_ur],
-                         [window_l, window, window_r],
-                         [window_bl, window_b, window_br]])
+        hann = w.hann(M=window_size, sym=False)
+        idx = np.arange(window_size)
+        profiles = np.stack([hann[np.maximum(idx, step)], hann, hann[np.minimum(idx, step)]])
+        return np.einsum("ai,bj->abij", profiles, profiles)
     
 
 class InferenceMerge:
@@ -308,10 +417,13 @@ class InferenceMerge:
         height (int): The padded height of roi.
         width (int): The padded width of roi.
         device (torch.device): The device to use for computation.
-        image (np.ndarray): The merged image.
-        norm_mask (np.ndarray): The normalization mask.
+        image (np.ndarray | torch.Tensor): The merged image, a device tensor when merging on GPU.
+        norm_mask (np.ndarray | torch.Tensor): The normalization mask, a device tensor when merging on GPU.
+        stripe_height (int): The number of rows reduced at a time when saving the mask.
     
     """
+    stripe_height: int = 1024
+    
     def __init__(self, 
                  height: int, 
                  width: int,
@@ -329,40 +441,60 @@ class InferenceMerge:
         self.width = width
         self.classes = classes
         self.device = device
-        self.image = np.zeros((self.classes, self.height, self.width), dtype=np.float16)
-        self.norm_mask = np.ones((1, self.height, self.width), dtype=np.float16)
-        # self.image = torch.zeros((self.classes, self.height, self.width), dtype=torch.float16, device=self.device)
-        # self.norm_mask = torch.ones((1, self.height, self.width), dtype=torch.float16, device=self.device)
+        if self.device.type == "cuda":
+            # Accumulators stay on device so patches never leave the GPU until save
+            self.image = torch.zeros((self.classes, self.height, self.width), dtype=torch.float16, device=self.device)
+            self.norm_mask = torch.ones((1, self.height, self.width), dtype=torch.float16, device=self.device)
+        else:
+            self.image = np.zeros((self.classes, self.height, self.width), dtype=np.float16)
+            self.norm_mask = np.ones((1, self.height, self.width), dtype=np.float16)
     
     @torch.no_grad()
-    def merge_on_cpu(self, batch: torch.Tensor, windows: torch.Tensor, pixel_coords):
+    def merge_on_cpu(self, batch: torch.Tensor, windows: torch.Tensor, pixel_coords: torch.Tensor):
         """
         Merge the patches on CPU.
 
         Args:
             batch (torch.Tensor): The batch of inference results.
             windows (torch.Tensor): The windows used for inference.
-            pixel_coords (list): The pixel coordinates of the patches.
+            pixel_coords (torch.Tensor): The (x, y, width, height) pixel coordinates of the patches, shape (B, 4).
 
         Returns:
             None
         """
-        for output, window, (x, y, patch_width, patch_height) in zip(batch, windows, pixel_coords):
-            # It is best to have these functions scripted in the model
-            # if self.classes == 1:
-            #     output = F.sigmoid(output) * window
-            # else:
-            #     output = F.softmax(output, dim=0) * window
-            output = output * window
-            self.image[:, y : y + patch_height, x : x + patch_width] += output.cpu().numpy()
-            self.norm_mask[:, y : y + patch_height, x : x + patch_width] += window.cpu().numpy()
+        # It is best to have these functions scripted in the model
+        # if self.classes == 1:
+        #     batch = F.sigmoid(batch) * windows
+        # else:
+        #     batch = F.softmax(batch, dim=1) * windows
+        # Weight and copy the whole batch to host at once, cast to the accumulator dtype
+        # so the in-place adds neither move nor allocate float32 data
+        outputs = (batch * windows).half().cpu().numpy()
+        windows = windows.half().cpu().numpy()
+        for output, window, (x, y, patch_width, patch_height) in zip(outputs, windows, pixel_coords.tolist()):
+            self.image[:, y : y + patch_height, x : x + patch_width] += output
+            self.norm_mask[:, y : y + patch_height, x : x + patch_width] += window
     
     @torch.no_grad()
-    def merge_on_gpu(self,):
+    def merge_on_gpu(self, batch: torch.Tensor, windows: torch.Tensor, pixel_coords: torch.Tensor):
         """
         Merge the patches on GPU.
+
+        Args:
+            batch (torch.Tensor): The batch of inference results.
+            windows (torch.Tensor): The windows used for inference.
+            pixel_coords (torch.Tensor): The (x, y, width, height) pixel coordinates of the patches, shape (B, 4).
+
+        Returns:
+            None
         """
-        pass
+        # Match the accumulator dtype so every in-place op below is a single kernel
+        batch = batch.to(self.image.dtype)
+        windows = windows.to(self.image.dtype)
+        for output, window, (x, y, patch_width, patch_height) in zip(batch, windows, pixel_coords.tolist()):
+            # addcmul_ weights and accumulates the patch without materializing the product
+            self.image[:, y : y + patch_height, x : x + patch_width].addcmul_(output, window)
+            self.norm_mask[:, y : y + patch_height, x : x + patch_width].add_(window)
 
     def save_as_tiff(self, 
                      height: int, 
@@ -382,17 +514,28 @@ class InferenceMerge:
             None
         """
         threshold = 0.5
-        self.image /= self.norm_mask
-        
-        # Binary mask
-        if self.image.shape[0] == 1:
-            self.image = expit(self.image)
-            self.image = np.where(self.image > threshold, 1, 0).squeeze(0).astype(np.uint8)
-        else:
-            self.image = np.argmax(self.image, axis=0).astype(np.uint8)
-            # self.image = torch.argmax(self.image, dim=0).byte().cpu().numpy()
+        # Reduce a stripe of rows at a time so only one normalized stripe is held in memory
+        mask = np.empty((1, height, width), dtype=np.uint8)
+        for y_min in range(0, height, self.stripe_height):
+            y_max = min(y_min + self.stripe_height, height)
+            stripe = self.image[:, y_min:y_max, :width]
+            # The normalization mask is shared by all classes and positive, so it cannot
+            # change the argmax and is only applied before thresholding a binary mask
+            if self.classes == 1:
+                stripe = stripe / self.norm_mask[:, y_min:y_max, :width]
+            if isinstance(stripe, torch.Tensor):
+                # Binary mask
+                if stripe.shape[0] == 1:
+                    stripe = torch.sigmoid(stripe).squeeze(0) > threshold
+                else:
+                    stripe = torch.argmax(stripe, dim=0)
+                mask[0, y_min:y_max] = stripe.to("cpu", torch.uint8).numpy()
+            elif stripe.shape[0] == 1:
+                mask[0, y_min:y_max] = expit(stripe).squeeze(0) > threshold
+            else:
+                mask[0, y_min:y_max] = np.argmax(stripe, axis=0)
             
-        self.image = self.image[np.newaxis, :height, :width]
+        self.image = mask
         output_meta.update({"driver": "GTiff",
                             "height": self.image.shape[1],
                             "width": self.image.shape[2],
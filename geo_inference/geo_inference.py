@@ -1,11 +1,11 @@
 import logging
+import os
 import time
 from pathlib import Path
 
 import torch
 import rasterio as rio
 from torch.utils.data import DataLoader
-from torchgeo.datasets import stack_samples
 from tqdm import tqdm
 
 from .config.logging_config import logger
@@ -27,13 +27,17 @@ class GeoInference:
         mask_to_vec (bool): Whether to convert the output mask to vector format.
         device (str): The device to use for inference (either "cpu" or "gpu").
         gpu_id (int): The ID of the GPU to use for inference (if device is "gpu").
+        num_workers (int): The number of DataLoader worker processes reading patches (0 reads in the main process).
 
     Attributes:
         batch_size (int): The batch size to use for inference.
         work_dir (Path): The directory where the model and output files will be saved.
         device (torch.device): The device to use for inference.
         mask_to_vec (bool): Whether to convert the output mask to vector format.
-        model (torch.jit.ScriptModule): The pre-trained model to use for inference.
+        num_workers (int): The number of DataLoader worker processes reading patches.
+        gdal_num_threads (int): The number of GDAL decoding threads per worker, None to keep GDAL_NUM_THREADS.
+        model (torch.jit.ScriptModule): The pre-trained model to use for inference, frozen for inference.
+        mixed_precision (bool): Whether the model runs under bfloat16 autocast (CUDA devices of compute capability 8.0+).
         classes (int): The number of classes in the output of the model.
 
     """
@@ -46,9 +50,11 @@ class GeoInference:
                  vec_to_yolo: bool = False,
                  vec_to_coco: bool = False,
                  device: str = "gpu",
-                 gpu_id: int = 0):
+                 gpu_id: int = 0,
+                 num_workers: int = 0):
         self.gpu_id = int(gpu_id)
         self.batch_size = int(batch_size)
+        self.num_workers = int(num_workers)
         self.work_dir: Path = get_directory(work_dir)
         self.device = get_device(device=device, 
                                  gpu_id=self.gpu_id)
@@ -57,11 +63,24 @@ class GeoInference:
         self.mask_to_vec = mask_to_vec
         self.vec_to_yolo = vec_to_yolo
         self.vec_to_coco = vec_to_coco
-        self.model = torch.jit.load(model_path, map_location=self.device)
+        # Let GDAL decode the blocks of a compressed patch in parallel, sharing the cores between
+        # the workers, unless the user configured it in their environment
+        self.gdal_num_threads = (None if "GDAL_NUM_THREADS" in os.environ 
+                                 else max(1, (os.cpu_count() or 1) // max(1, self.num_workers)))
+        self.model = torch.jit.freeze(torch.jit.load(model_path, map_location=self.device).eval())
+        # Native bfloat16 needs compute capability 8.0+ on the selected GPU, older cards only emulate it
+        self.mixed_precision = (self.device.type == "cuda" 
+                                and torch.cuda.get_device_capability(self.device)[0] >= 8)
         dummy_input = torch.ones((1, 3, 32, 32), device=self.device)
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             self.classes = self.model(dummy_input).shape[1]
     
+    def _autocast(self) -> torch.autocast:
+        """
+        Returns the autocast context the model runs under, disabled unless mixed_precision is set.
+        """
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+    
     @torch.no_grad() 
     def __call__(self, 
                  tiff_image: str, 
@@ -93,24 +112,47 @@ class GeoInference:
         yolo_csv_path = self.work_dir.joinpath(tiff_id + "_yolo.csv")
         coco_json_path = self.work_dir.joinpath(tiff_id + "_coco.json")
         
-        dataset = RasterDataset(tiff_image, bbox=bbox)
+        dataset = RasterDataset(tiff_image, bbox=bbox, num_threads=self.gdal_num_threads)
         sampler = InferenceSampler(dataset, size=patch_size, 
                                    stride=patch_size >> 1 if stride_size is None else stride_size, roi=dataset.bbox)
         roi_height = sampler.im_height 
         roi_width = sampler.im_width
         h_padded, w_padded = roi_height + patch_size, roi_width + patch_size
-        output_meta = dataset.src.meta
+        output_meta = dataset.src_meta
         merge_patches = InferenceMerge(height=h_padded, width=w_padded, classes=self.classes, device=self.device)
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, sampler=sampler, collate_fn=stack_samples)
+        windows = sampler.windows.to(self.device)
+        # Workers read patches ahead so raster I/O overlaps with inference
+        loader_kwargs = dict(num_workers=self.num_workers, prefetch_factor=4) if self.num_workers else {}
+        use_cuda = self.device.type == "cuda"
+        dataloader = DataLoader(dataset, batch_size=self.batch_size, sampler=sampler, 
+                                pin_memory=use_cuda, **loader_kwargs)
+        # Host to device copies run on a side stream so they overlap with the previous batch
+        copy_stream = torch.cuda.Stream(device=self.device) if use_cuda else None
         
         start_time = time.time()
         
         for batch in tqdm(dataloader, desc='extracting features', unit='batch', total=len(dataloader)):
-            image_tensor = batch["image"].to(self.device)
-            window_tensor = batch["window"].unsqueeze(1).to(self.device)
+            if use_cuda:
+                with torch.cuda.stream(copy_stream):
+                    image_tensor = batch["image"].to(self.device, non_blocking=True)
+                    window_ids = batch["window_id"].to(self.device, torch.long, non_blocking=True)
+                compute_stream = torch.cuda.current_stream(self.device)
+                compute_stream.wait_stream(copy_stream)
+                image_tensor.record_stream(compute_stream)
+                window_ids.record_stream(compute_stream)
+            else:
+                image_tensor = batch["image"]
+                window_ids = batch["window_id"].long()
+            window_tensor = windows[window_ids].unsqueeze(1)
             pixel_xy = batch["pixel_coords"]
-            output = self.model(image_tensor) 
-            merge_patches.merge_on_cpu(batch=output, windows=window_tensor, pixel_coords=pixel_xy)
+            with self._autocast():
+                output = self.model(image_tensor)
+            # Merge in full precision regardless of the precision of the forward pass
+            output = output.float()
+            if self.device.type == "cuda":
+                merge_patches.merge_on_gpu(batch=output, windows=window_tensor, pixel_coords=pixel_xy)
+            else:
+                merge_patches.merge_on_cpu(batch=output, windows=window_tensor, pixel_coords=pixel_xy)
         merge_patches.save_as_tiff(height=dataset.image_height, 
                                    width=dataset.image_width, 
                                    output_meta=output_meta, 
@@ -123,7 +165,7 @@ class GeoInference:
             if self.vec_to_coco:
                 geojson2coco(mask_path, polygons_path, coco_json_path)
         
-        dataset.src.close()    
+        dataset.close()    
         end_time = time.time() - start_time
         
         logger.info('Extraction Completed in {:.0f}m {:.0f}s'.format(end_time // 60, end_time % 60))
@@ -137,7 +179,8 @@ def main() -> None:
                                  vec_to_yolo=arguments["yolo"],
                                  vec_to_coco=arguments["coco"],
                                  device=arguments["device"],
-                                 gpu_id=arguments["gpu_id"])
+                                 gpu_id=arguments["gpu_id"],
+                                 num_workers=arguments["num_workers"])
     geo_inference(tiff_image=arguments["image"], bbox=arguments["bbox"])
                
 if __name__ == "__main__":
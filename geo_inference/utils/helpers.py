@@ -253,6 +253,8 @@ def cmd_interface(argv=None):
     
     parser.add_argument("-id", "--gpu_id", nargs=1, help="GPU ID, Default = 0")
     
+    parser.add_argument("-nw", "--num_workers", nargs=1, help="Number of patch reading workers, Default = 0")
+    
     args = parser.parse_args()
     
     if args.args:
@@ -267,6 +269,7 @@ def cmd_interface(argv=None):
         coco = config["arguments"]["coco"]
         device = config["arguments"]["device"]
         gpu_id = config["arguments"]["gpu_id"]
+        num_workers = config["arguments"].get("num_workers", 0)
     elif args.image:
         image = args.image[0]
         bbox = args.bbox[0] if args.bbox else None
@@ -278,6 +281,7 @@ def cmd_interface(argv=None):
         coco = args.coco[0] if args.coco else False
         device = args.device[0] if args.device else "gpu"
         gpu_id = args.gpu_id[0] if args.gpu_id else 0
+        num_workers = args.num_workers[0] if args.num_workers else 0
     else:
         print('use the help [-h] option for correct usage')
         raise SystemExit
@@ -291,7 +295,8 @@ def cmd_interface(argv=None):
                 "yolo": yolo,
                 "coco": coco,
                 "device": device,
-                "gpu_id": gpu_id
+                "gpu_id": gpu_id,
+                "num_workers": num_workers
                 }
     return arguments
     
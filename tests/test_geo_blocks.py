@@ -1,7 +1,7 @@
 from pathlib import Path
-from typing import Any, Dict
 
 import os
+import pickle
 import pytest
 import numpy as np
 import scipy.signal.windows as w
@@ -25,20 +25,41 @@ class TestRasterDataset:
         assert raster_dataset.bands > 0
         assert raster_dataset.res > 0
         assert raster_dataset._crs is not None
+        assert raster_dataset.src_meta == raster_dataset.src.meta
+
+    def test_pickle(self, raster_dataset):
+        restored = pickle.loads(pickle.dumps(raster_dataset))
+        assert restored.src is None
+        assert restored.src_meta == raster_dataset.src_meta
+        tensor = restored._get_tensor((0, 0, 10, 10), 10)
+        assert torch.equal(tensor, raster_dataset._get_tensor((0, 0, 10, 10), 10))
+        restored.close()
+
+    def test_close(self, raster_dataset):
+        raster_dataset.close()
+        assert raster_dataset.src.closed
+        assert raster_dataset.src_meta["count"] == raster_dataset.bands
 
     def test_getitem(self, raster_dataset):
-        query: Dict[str, Any] = {
-            'path': raster_dataset.src.name,
-            'window': (0, 0, 10, 10),  # replace with actual window
-            'pixel_coords': (0, 0, 10, 10)  # replace with actual pixel_coords
-        }
+        query = [0, 0, 10, 10, 4]
         sample = raster_dataset.__getitem__(query)
         assert isinstance(sample, dict)
         assert 'image' in sample
-        assert 'crs' in sample
         assert 'pixel_coords' in sample
-        assert 'window' in sample
-        assert 'path' in sample
+        assert 'window_id' in sample
+        assert sample['image'].shape[-2:] == (10, 10)
+        assert sample['pixel_coords'].tolist() == [0, 0, 10, 10]
+        assert sample['window_id'].item() == 4
+
+    def test_getitems(self, raster_dataset):
+        queries = [[0, 0, 10, 10, 0], [5, 0, 10, 10, 1], [0, 5, 10, 10, 3], [10, 0, 10, 10, 1]]
+        samples = raster_dataset.__getitems__(queries)
+        assert len(samples) == len(queries)
+        for query, sample in zip(queries, samples):
+            expected = raster_dataset.__getitem__(query)
+            assert torch.equal(sample['image'], expected['image'])
+            assert sample['pixel_coords'].tolist() == query[:4]
+            assert sample['window_id'].item() == query[4]
 
     def test_get_tensor(self, raster_dataset):
         query = (0, 0, 10, 10)  # replace with actual query
@@ -53,6 +74,7 @@ class TestRasterDataset:
         padded = RasterDataset.pad_patch(x, patch_size)
         assert isinstance(padded, torch.Tensor)
         assert padded.shape[-2:] == (patch_size, patch_size)
+        assert RasterDataset.pad_patch(padded, patch_size) is padded
 
 
 class TestInferenceSampler:
@@ -66,17 +88,28 @@ class TestInferenceSampler:
         assert inference_sampler.size == (10, 10)
         assert inference_sampler.stride == (5, 5)
         assert inference_sampler.length > 0
+        assert inference_sampler.windows.shape == (10, 10, 10)
+        assert torch.all(inference_sampler.windows[-1] == 1)
 
     def test_iter(self, inference_sampler):
         for sample in inference_sampler:
-            assert isinstance(sample, dict)
-            assert 'pixel_coords' in sample
-            assert 'path' in sample
-            assert 'window' in sample
+            assert isinstance(sample, list)
+            assert len(sample) == 5
+            assert sample[2:4] == [10, 10]
 
     def test_len(self, inference_sampler):
         assert len(inference_sampler) == inference_sampler.length
 
+    def test_generate_patch_coords(self):
+        coords = InferenceSampler.generate_patch_coords(23, 17, (10, 10), (5, 5))
+        assert coords.shape == (4 * 3, 5)
+        assert coords[:, 0].max() == 17 - 10
+        assert coords[:, 1].max() == 23 - 10
+        assert tuple(coords[0]) == (0, 0, 10, 10, 0)
+        assert tuple(coords[1]) == (5, 0, 10, 10, 1)
+        assert tuple(coords[3]) == (0, 5, 10, 10, 3)
+        assert tuple(coords[-1]) == (7, 13, 10, 10, 8)
+
     def test_generate_corner_windows(self):
         window_size = 10
         step = window_size >> 1
@@ -128,11 +161,35 @@ class TestInferenceMerge:
     def test_merge_on_cpu(self, inference_merge):
         batch = torch.rand((3, 3, 10, 10))
         windows = torch.rand((3, 1, 10, 10))
-        pixel_coords = [(0, 0, 10, 10), (10, 10, 10, 10), (20, 20, 10, 10)]
+        pixel_coords = torch.tensor([(0, 0, 10, 10), (10, 10, 10, 10), (20, 20, 10, 10)], dtype=torch.int32)
         inference_merge.merge_on_cpu(batch, windows, pixel_coords)
         assert np.all(inference_merge.image >= 0)
         assert np.all(inference_merge.norm_mask >= 1)
 
+    def test_merge_on_gpu_matches_cpu(self, inference_merge):
+        # merge_on_gpu only uses torch ops, so it can run on CPU tensor accumulators
+        gpu_merge = InferenceMerge(100, 100, 3, torch.device('cpu'))
+        gpu_merge.image = torch.zeros((3, 100, 100))
+        gpu_merge.norm_mask = torch.ones((1, 100, 100))
+        batch = torch.rand((3, 3, 10, 10))
+        windows = torch.rand((3, 1, 10, 10))
+        pixel_coords = torch.tensor([(0, 0, 10, 10), (5, 5, 10, 10), (20, 20, 10, 10)], dtype=torch.int32)
+        inference_merge.merge_on_cpu(batch, windows, pixel_coords)
+        gpu_merge.merge_on_gpu(batch, windows, pixel_coords)
+        assert np.allclose(gpu_merge.image.numpy(), inference_merge.image, atol=1e-2)
+        assert np.allclose(gpu_merge.norm_mask.numpy(), inference_merge.norm_mask, atol=1e-2)
+
+    @pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+    def test_merge_on_gpu(self):
+        inference_merge = InferenceMerge(100, 100, 3, torch.device('cuda'))
+        assert isinstance(inference_merge.image, torch.Tensor)
+        batch = torch.rand((3, 3, 10, 10), device='cuda')
+        windows = torch.rand((3, 1, 10, 10), device='cuda')
+        pixel_coords = torch.tensor([(0, 0, 10, 10), (10, 10, 10, 10), (20, 20, 10, 10)], dtype=torch.int32)
+        inference_merge.merge_on_gpu(batch, windows, pixel_coords)
+        assert torch.all(inference_merge.image >= 0)
+        assert torch.all(inference_merge.norm_mask >= 1)
+
     def test_save_as_tiff(self, inference_merge, test_data_dir):
         height = 100
         width = 100
@@ -143,4 +200,22 @@ class TestInferenceMerge:
         output_path = test_data_dir / "test_1.tiff"
         inference_merge.save_as_tiff(height, width, output_meta, output_path)
         assert output_path.exists()
-        os.remove(output_path)
\ No newline at end of file
+        os.remove(output_path)
+
+    def test_save_as_tiff_stripes(self, inference_merge, test_data_dir):
+        height = 90
+        width = 80
+        inference_merge.stripe_height = 16
+        inference_merge.image[:] = np.random.rand(3, 100, 100)
+        expected = np.argmax(inference_merge.image, axis=0)[:height, :width]
+        output_meta = {
+            "crs": "+proj=latlong",
+            "transform": rio.Affine(1.0, 0, 0, 0, 1.0, 0)
+        }
+        output_path = test_data_dir / "test_stripes.tiff"
+        inference_merge.save_as_tiff(height, width, output_meta, output_path)
+        with rio.open(output_path) as src:
+            mask = src.read(1)
+        os.remove(output_path)
+        assert mask.shape == (height, width)
+        assert np.array_equal(mask, expected)
\ No newline at end of file
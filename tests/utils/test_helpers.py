@@ -136,7 +136,8 @@ def test_cmd_interface_with_args(monkeypatch, test_data_dir):
                       "yolo": False,
                       "coco": False,
                       "device": "gpu",
-                      "gpu_id": 0
+                      "gpu_id": 0,
+                      "num_workers": 0
                       }
 
 def test_cmd_interface_with_image(monkeypatch):
@@ -155,7 +156,8 @@ def test_cmd_interface_with_image(monkeypatch):
         "yolo": False,
         "coco": False,
         "device": "gpu",
-        "gpu_id": 0
+        "gpu_id": 0,
+        "num_workers": 0
     }
 
 def test_cmd_interface_no_args(monkeypatch):